@@ -1,10 +1,66 @@
-from .utils import split_formula, get_info_from_design_matrix, get_P_from_design_matrix, orthogonalize_spline_wrt_non_splines, spline, compute_orthogonalization_pattern_deepnets
+from .utils import split_formula, get_info_from_design_matrix, get_P_from_design_matrix, _get_P_from_design_info, orthogonalize_spline_wrt_non_splines, spline, compute_orthogonalization_pattern_deepnets
 from patsy import dmatrix, build_design_matrices
 import torch
+import numpy as np
 import pandas as pd
 import os
+import hashlib
 import torch.nn as nn
 
+
+# cache for the design infos and spline spectra of the structured design matrices built in PrepareData.fit, 
+# see _get_structured_design_info_and_P
+_structured_design_cache = dict()
+_STRUCTURED_DESIGN_CACHE_SIZE = 8
+
+
+def _get_structured_design_info_and_P(structured_term, data, dfs):
+    '''
+    Builds the patsy design matrix for the structured part of a formula and computes its penalty matrix. The design info and the
+    spectra of the spline penalties (see get_P_from_design_matrix) only depend on the formula and the data, so they are cached.
+    Fitting the same formula on the same data again, e.g. with other degrees of freedom, then skips building the design 
+    matrix and the eigen-decompositions of the penalties. The design matrix itself is not cached.
+
+    Parameters
+    ----------
+        structured_term: string
+            The structured part of the formula, e.g. '1 + x1 + spline(x2, bs="bs", df=9)'.
+        data: Pandas.DataFrame
+            input data (X)
+        dfs: int or list of ints
+            Degrees from freedom of the splines (see get_P_from_design_matrix).
+
+    Returns
+    -------
+        design_info: patsy DesignInfo
+            The design info of the design matrix for the structured part of the formula.
+        P: numpy array
+            The penalty matrix of the design matrix.
+    '''
+    try:
+        data_hash = hashlib.sha1(pd.util.hash_pandas_object(data, index=False).to_numpy()).hexdigest()
+        # the hash does not depend on the dtypes (e.g. a categorical column is hashed like its values), but the design matrix does
+        key = (structured_term, tuple(data.columns), tuple(data.dtypes), data_hash)
+    except TypeError:
+        # data can not be hashed (e.g. unhashable objects in a column), so build the design matrix without caching
+        key = None
+
+    if key in _structured_design_cache:
+        design_info, spectra = _structured_design_cache[key]
+        return design_info, _get_P_from_design_info(design_info, dfs, spectra)
+
+    structured_matrix = dmatrix(structured_term, data, return_type='matrix')
+    spectra = dict()
+    P = get_P_from_design_matrix(structured_matrix, dfs, spectra)
+
+    if key is not None:
+        if len(_structured_design_cache) >= _STRUCTURED_DESIGN_CACHE_SIZE:
+            # remove the oldest entry
+            del _structured_design_cache[next(iter(_structured_design_cache))]
+        _structured_design_cache[key] = (structured_matrix.design_info, spectra)
+    return structured_matrix.design_info, P
+
+
 class PrepareData(object):
     '''
     The Prepare_Data class parses the formulas defined by the user. This class includes fit and transform functions, which parses all information necessary to initialize the sddr network and also prepares the data by calculating penalty matrices (multiplied by the smoothing parameters lambda, which are computed from degrees of freedom) and orthogonalizing the non-linear (e.g. splines) wrt to the linear part of the formula.
@@ -136,13 +192,12 @@ class PrepareData(object):
 
             dfs = self.degrees_of_freedom[param]
 
-            # create the structured matrix from the structured part of the formula - based on patsy
-            structured_matrix = dmatrix(self.formula_terms_dict[param]["structured_term"], data, return_type='dataframe')
-            self.structured_matrix_design_info[param] = structured_matrix.design_info
-
-            # compute the penalty matrix and add content to the dicts to be returned
-            self.P[param] = get_P_from_design_matrix(structured_matrix, dfs)  
-            self.network_info_dict[param]['struct_shapes'] = structured_matrix.shape[1]
+            # create the structured matrix from the structured part of the formula - based on patsy - and compute the penalty 
+            # matrix (cached on formula and data). Add content to the dicts to be returned
+            design_info, self.P[param] = _get_structured_design_info_and_P(self.formula_terms_dict[param]["structured_term"], 
+                                                                            data, dfs)
+            self.structured_matrix_design_info[param] = design_info
+            self.network_info_dict[param]['struct_shapes'] = len(design_info.column_names)
     '''
     def set_structured_matrix_design_info(self, structured_matrix_design_info):
         self.structured_matrix_design_info = structured_matrix_design_info
@@ -187,7 +242,7 @@ class PrepareData(object):
 
             # create the structured matrix using the same specification of the spline basis 
             try:
-                structured_matrix = build_design_matrices([self.structured_matrix_design_info[param]], data, NA_action='raise', return_type='dataframe')[0]
+                structured_matrix = build_design_matrices([self.structured_matrix_design_info[param]], data, NA_action='raise', return_type='matrix')[0]
             except Exception as e:
                 if clipping == True:
                     train_data_min = {}
@@ -196,7 +251,7 @@ class PrepareData(object):
                         train_data_min[name]=self.data_range[0][name]
                         train_data_max[name]=self.data_range[1][name]
                     clipped_data = data.clip(lower=pd.Series(train_data_min),upper=pd.Series(train_data_max),axis=1)
-                    structured_matrix = build_design_matrices([self.structured_matrix_design_info[param]], clipped_data, NA_action='raise', return_type='dataframe')[0]
+                    structured_matrix = build_design_matrices([self.structured_matrix_design_info[param]], clipped_data, NA_action='raise', return_type='matrix')[0]
                 else:
                     raise Exception("Data should stay within the range of the training data. Please try clipping or manually set knots.")
 
@@ -212,11 +267,13 @@ class PrepareData(object):
                                                                                        non_spline_info) 
                 
                 self.network_info_dict[param]['orthogonalization_pattern'][net_name] = orthogonalization_pattern
-            # orthogonalize splines with respect to non-splines (including an intercept if it is there)
-            orthogonalize_spline_wrt_non_splines(structured_matrix, spline_info, non_spline_info)
+            # orthogonalize splines with respect to non-splines (including an intercept if it is there). This is done inplace on 
+            # the freshly built design matrix, which is already a float64 numpy array, so no copy is needed
+            structured_array = np.asarray(structured_matrix, dtype=np.float64)
+            orthogonalize_spline_wrt_non_splines(structured_array, spline_info, non_spline_info)
 
             # add content to the dicts to be returned
-            prepared_data[param]["structured"] = torch.from_numpy(structured_matrix.values).float()
+            prepared_data[param]["structured"] = torch.from_numpy(structured_array).float()
 
             for net_name in self.formula_terms_dict[param]['net_feature_names'].keys():
                 net_feature_names = self.formula_terms_dict[param]['net_feature_names'][net_name]
@@ -49,8 +49,11 @@ class Spline(object):
 
 
     def transform(self, x, bs, df=4, degree=3, return_penalty = False,knot_kwds = None):
-        
-        return self.s.transform(np.expand_dims(x.to_numpy(),axis=1)) 
+        # x can be a pandas Series or a numpy array (1D or already 2D with a single column). The spline basis expects a 2D array
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x[:, None]
+        return self.s.transform(x)
             
 
     __getstate__ = no_pickling
@@ -5,7 +5,7 @@ import warnings
 import os
 from torch import nn
 import torch
-import parser
+import functools
 from .splines import spline, Spline
 
 
@@ -62,15 +62,14 @@ def split_formula(formula, net_names_list):
     """
     structured_terms = []
     unstructured_terms = []
+    net_names = frozenset(net_names_list)
     # remove spaces the tilde and split into formula terms
-    formula = formula.replace(' ','')
-    formula = formula.replace('~','')
-    formula_parts = formula.split('+')
+    formula_parts = formula.replace(' ','').replace('~','').split('+')
     # for each formula term
     for part in formula_parts:
-        term = part.split('(')[0]
+        term = part.partition('(')[0]
         # if it an unstructured part
-        if term in net_names_list:
+        if term in net_names:
             # append it to a list
             unstructured_terms.append(part)
         else:
@@ -97,16 +96,22 @@ def make_matrix_positive_semi_definite(A,machine_epsilon):
         A : numpy array
             A matrix that is semipositive definite.
     """
-    #get smallest eigenvalue for a symmetric matrix and use some additional tolerance to ensure semipositive definite matrices
-    min_eigen = min(np.linalg.eigh(A)[0]) - np.sqrt(machine_epsilon)
+    # in the common case the smallest eigenvalue of A is large enough (at least sqrt(machine_epsilon) - 1e-10, see below), which a
+    # Cholesky decomposition of the shifted matrix checks much faster than an eigen-decomposition
+    try:
+        sp.linalg.cholesky(A - (np.sqrt(machine_epsilon) - 1e-10) * np.identity(A.shape[0]))
+        return (A)
+    except np.linalg.LinAlgError:
+        pass
+
+    #get smallest eigenvalue (only this one is computed) for a symmetric matrix and use some additional tolerance to ensure semipositive definite matrices
+    min_eigen = sp.linalg.eigh(A, eigvals_only=True, subset_by_index=[0, 0])[0] - np.sqrt(machine_epsilon)
 
     # smallest eigenvalue negative = not semipositive definit
     if min_eigen < -1e-10:
+        # after this shift the smallest eigenvalue is rho * sqrt(machine_epsilon) > 0, so a single shift is enough
         rho = 1 / (1 - min_eigen)
         A = rho * A + (1 - rho) * np.identity(A.shape[0])
-
-        ## now check if it is really positive definite by recursively calling
-        A = make_matrix_positive_semi_definite(A,machine_epsilon)
     return (A)
 
 
@@ -119,24 +124,187 @@ def df_fun(lam, d, hat1):
     ----------
         lam : int
             Lambda value.
-        d : int
+        d : numpy array
             Vector of singular values from SVD.
+        hat1 : bool
+            If True, df is the trace of the hat matrix H, otherwise the trace of 2H - H^2.
 
     Returns
     -------
         df : int
             Degrees of Freedom.
     """
+    # diagonal of the hat matrix in the basis that diagonalizes the penalty
+    h = 1 / (1 + lam * np.asarray(d))
     if hat1:
-        df = sum(1 / (1 + lam * d))
+        df = h.sum()
     else:
-        df = 2 * sum(1 / (1 + lam * d)) - sum(1 / (1 + lam * d) ^ 2)
+        df = 2 * h.sum() - (h * h).sum()
     return df
 
 
 
 
-def df2lambda(dm, P, df, lam = None, hat1 = True, lam_max = 1e+15):
+def _get_design_matrix_rank(dm):
+    """
+    Computes the rank of a design matrix from a single SVD (with the tolerance of np.linalg.matrix_rank).
+
+    Parameters
+    ----------
+        dm : patsy.dmatrix or numpy array
+            The design matrix.
+
+    Returns
+    -------
+        rank_dm: int
+            Rank of the design matrix.
+    """
+    s_dm = np.linalg.svd(dm, compute_uv = False)
+    rank_dm = int((s_dm > s_dm.max() * max(dm.shape) * np.finfo(float).eps).sum())
+    return rank_dm
+
+
+
+
+def _get_df2lambda_singular_values(dm, P, XtX = None):
+    """
+    Computes the singular values used in df_fun. They depend only on the design matrix and the penalty matrix, not on df or lambda.
+
+    Parameters
+    ----------
+        dm : patsy.dmatrix or numpy array
+            The design matrix of a single spline term.
+        P: numpy-array
+            The penalty matrix of the design matrix.
+        XtX: numpy array, default None
+            dm.T @ dm. Computed here if not given.
+
+    Returns
+    -------
+        d: numpy array
+            Vector of singular values used in df_fun.
+    """
+    ## define tolerance value, here we use machine epsilon
+    machine_epsilon = np.finfo(float).eps * 2
+
+    if XtX is None:
+        dm = np.ascontiguousarray(dm, dtype=np.float64)
+        XtX = dm.T @ dm
+
+    # avoid that XtX matrix is not (numerically) singular. For rank deficient design matrices (e.g. a spline with more basis 
+    # functions than distinct values of its input) A has to be shifted, otherwise the eigenvalues below are dominated by rounding
+    A = XtX + P * 1e-15
+    A = make_matrix_positive_semi_definite(A,machine_epsilon)
+
+    # vector (d) with the eigenvalues of the generalized symmetric eigenproblem P v = d A v. With A = R.T @ R (Cholesky) these are the
+    # singular values of R^-T @ P @ R^-1, but a single LAPACK call (sygvd) computes them without forming R^-1 explicitly
+    d = sp.linalg.eigh(P, A, eigvals_only=True, driver='gvd')
+    # singular values are non-negative, eigenvalues of the (positive semi-definite) penalty can be slightly negative due to rounding
+    d = np.abs(d)
+
+    return d
+
+
+
+
+def _get_df2lambda_spectrum(dm, P, XtX = None):
+    """
+    Computes the parts of df2lambda that depend only on the design matrix and the penalty matrix, not on df or lambda.
+
+    Parameters
+    ----------
+        dm : patsy.dmatrix or numpy array
+            The design matrix of a single spline term.
+        P: numpy-array
+            The penalty matrix of the design matrix.
+        XtX: numpy array, default None
+            dm.T @ dm. Computed here if not given.
+
+    Returns
+    -------
+        rank_dm: int
+            Rank of the design matrix.
+        d: numpy array
+            Vector of singular values used in df_fun.
+    """
+    dm = np.ascontiguousarray(dm, dtype=np.float64)
+    return _get_design_matrix_rank(dm), _get_df2lambda_singular_values(dm, P, XtX)
+
+
+
+
+def _get_df2lambda_spectra(dm_splines, Ps, XtXs = None):
+    """
+    Computes the spectra of several spline terms (see _get_df2lambda_spectrum). The ranks are computed per term, the small 
+    k x k problems (Cholesky decomposition and eigenvalues) of all terms are zero padded to the same size and solved together.
+
+    Parameters
+    ----------
+        dm_splines : list of patsy.dmatrix or numpy arrays
+            The design matrices of the spline terms (all with the same number of rows).
+        Ps: list of numpy-arrays
+            The penalty matrices of the spline terms.
+        XtXs: list of numpy arrays, default None
+            dm.T @ dm for each of the design matrices. Computed here if not given.
+
+    Returns
+    -------
+        spectra: list of tuples
+            Rank of the design matrix and vector of singular values used in df_fun for each spline term.
+    """
+    ## define tolerance value, here we use machine epsilon
+    machine_epsilon = np.finfo(float).eps * 2
+
+    if XtXs is None:
+        XtXs = [None] * len(dm_splines)
+
+    # nothing to batch for a single spline
+    if len(dm_splines) == 1:
+        return [_get_df2lambda_spectrum(dm_splines[0], Ps[0], XtXs[0])]
+
+    num_splines = len(dm_splines)
+    num_columns = [P.shape[0] for P in Ps]
+    max_num_columns = max(num_columns)
+
+    # zero padding of the penalties adds zero eigenvalues, the identity block in the padding of A keeps the stacked A 
+    # positive definite. A is shifted for each term as in _get_df2lambda_spectrum
+    rank_dm = []
+    P_stacked = np.zeros((num_splines, max_num_columns, max_num_columns))
+    A_stacked = np.zeros((num_splines, max_num_columns, max_num_columns))
+    for i, (dm_spline, P, XtX) in enumerate(zip(dm_splines, Ps, XtXs)):
+        k = num_columns[i]
+        dm_spline = np.asarray(dm_spline, dtype=np.float64)
+        rank_dm.append(_get_design_matrix_rank(dm_spline))
+        if XtX is None:
+            XtX = dm_spline.T @ dm_spline
+        P_stacked[i, :k, :k] = P
+        A_stacked[i, :k, :k] = make_matrix_positive_semi_definite(XtX + P * 1e-15, machine_epsilon)
+        A_stacked[i, range(k, max_num_columns), range(k, max_num_columns)] = 1
+
+    try:
+        L = np.linalg.cholesky(A_stacked)
+    except np.linalg.LinAlgError:
+        # at least one A is numerically not positive definite, use the generalized eigenproblem for each spline
+        return [_get_df2lambda_spectrum(dm_spline, P, XtX) for dm_spline, P, XtX in zip(dm_splines, Ps, XtXs)]
+
+    # eigenvalues of L^-1 @ P @ L^-T, the same values as from the generalized eigenproblem in _get_df2lambda_spectrum. 
+    # L is lower triangular, so two triangular solves (trsm) are enough, without LU factorizing L or forming its inverse
+    M = np.empty_like(P_stacked)
+    for i in range(num_splines):
+        Y = sp.linalg.solve_triangular(L[i], P_stacked[i], lower=True, check_finite=False)
+        M[i] = sp.linalg.solve_triangular(L[i], Y.T, lower=True, check_finite=False)
+    d = np.abs(np.linalg.eigvalsh(M))
+
+    spectra = []
+    for i, k in enumerate(num_columns):
+        # remove the zero eigenvalues that come from the padding
+        spectra.append((rank_dm[i], np.sort(d[i])[max_num_columns - k:]))
+    return spectra
+
+
+
+
+def df2lambda(dm, P, df, lam = None, hat1 = True, lam_max = 1e+15, spectrum = None):
     """
     Calculates lambda from degrees of freedom (default) or degrees of freedom from lambda.
 
@@ -152,6 +320,10 @@ def df2lambda(dm, P, df, lam = None, hat1 = True, lam_max = 1e+15):
             Lambda value.
         lam_max: int, default 1e+15
             Maximum value for lambda. Can be adjusted depending on needs.
+        spectrum: tuple, default None
+            Rank of dm and singular values as returned by _get_df2lambda_spectrum(dm, P). They do not depend on df or lambda,
+            so they can be computed once and reused. If not given, only the parts needed for the given df or lambda are computed 
+            here (e.g. no rank for a non-zero lambda).
 
     Returns
     -------
@@ -167,9 +339,15 @@ def df2lambda(dm, P, df, lam = None, hat1 = True, lam_max = 1e+15):
     if df == None and lam == None:
         raise Exception('Either degrees of freedom or lambda has to be provided.')
 
+    if spectrum is not None:
+        rank_dm, d = spectrum
+    else:
+        rank_dm, d = None, None
+
     ## check if rank of design matrix is large enough for given df
     if df != None:
-        rank_dm = np.linalg.matrix_rank(dm)
+        if rank_dm is None:
+            rank_dm = _get_design_matrix_rank(dm)
         if df >= rank_dm:
             warnings.simplefilter('always')
             warnings.warn("""df too large: Degrees of freedom (df = {0}) cannot be larger than the rank of the design matrix (rank = {1}). 
@@ -180,26 +358,12 @@ def df2lambda(dm, P, df, lam = None, hat1 = True, lam_max = 1e+15):
     ## if lambda is given, but equal 0, return rank of design matrix as df
     if lam != None:
         if lam == 0:
-            df = np.linalg.matrix_rank(dm)
+            df = rank_dm if rank_dm is not None else _get_design_matrix_rank(dm)
             return df, lam
 
     ## otherwise compute df or lambda
-
-    # avoid that XtX matrix is not (numerically) singular
-    XtX = dm.T @ dm
-
-    # make sure that A is numerically positiv semi-definit and also numerically symmetric
-    A = XtX + P * 1e-15
-    A = make_matrix_positive_semi_definite(A,machine_epsilon)
-    Rm = sp.linalg.solve_triangular(sp.linalg.cholesky(A, lower=False), np.identity(XtX.shape[1]))
-
-    # singular value decomposition and return vector (d) with singular values (might be possible to speed up if set 'hermitian = True')
-    try:
-        # try computation without computing u and vh
-        d = np.linalg.svd((Rm.T @ P) @ Rm, compute_uv = False)
-    except:
-        # if unsuccessful try the same computation but compute u and vh as well
-        d = np.linalg.svd((Rm.T @ P) @ Rm, compute_uv=True)[1]
+    if d is None:
+        d = _get_df2lambda_singular_values(dm, P)
 
     # if lambda given compute degrees of freedom
     if lam != None:
@@ -220,9 +384,10 @@ def df2lambda(dm, P, df, lam = None, hat1 = True, lam_max = 1e+15):
         return df, lam
 
     lam = sp.optimize.brentq(lambda l: df_fun(l, d, hat1) - df, 0, lam_max)
-    if abs(df_fun(lam, d, hat1) - df) > np.sqrt(machine_epsilon):
+    df_deviation = df_fun(lam, d, hat1) - df
+    if abs(df_deviation) > np.sqrt(machine_epsilon):
         warnings.simplefilter('always')
-        warnings.warn("""estimated df differ from given df by {0} """.format(df_fun(lam, d, hat1) - df), stacklevel=2)
+        warnings.warn("""estimated df differ from given df by {0} """.format(df_deviation), stacklevel=2)
 
     return df, lam
 
@@ -280,7 +445,7 @@ def _get_penalty_matrix_from_factor_info(factor_info):
 
 
 
-def get_P_from_design_matrix(dm, dfs):
+def get_P_from_design_matrix(dm, dfs, spectra = None):
     """
     Computes and returns the penalty matrix that corresponds to a patsy design matrix. The penalties are multiplied by the regularization parameters lambda computed from given degrees of freedom.
     The result is a single block diagonal penalty matrix that combines the penalty matrices of each term in the formula that was used to create the design matrix. Only smooting splines terms have a non-zero penalty matrix.
@@ -294,72 +459,164 @@ def get_P_from_design_matrix(dm, dfs):
             Degrees from freedom from which the smoothing parameter lambda is computed.
             Either a single value for all penalities of all splines, or a list of values, each for one of the splines that appear 
             in the formula.
+        spectra: dictionary, default None
+            A dictionary where keys are the term names of the splines and values are the spectra used by df2lambda (see 
+            _get_df2lambda_spectrum). Missing spectra are computed and added to the dictionary, so that passing the same 
+            dictionary again for the same design matrix only has to solve for the new lambdas.
 
     Returns
     -------
         big_P: numpy array
             The penalty matrix of the design matrix.
     """
-    factor_infos = dm.design_info.factor_infos
-    terms = dm.design_info.terms
-    
-    big_P = np.zeros((dm.shape[1],dm.shape[1]))
-    
-    spline_counter = 0
+    if spectra is None:
+        spectra = dict()
+
+    spline_terms = _get_spline_terms(dm.design_info)
+
+    # compute the missing spectra of all splines together
+    missing_spline_terms = [spline_term for spline_term in spline_terms if spline_term[0] not in spectra]
+    if len(missing_spline_terms) > 0:
+        # slicing the numpy array is cheaper than .iloc. The spline terms do not overlap, so only the cross products of the 
+        # spline blocks of the design matrix are needed
+        X = np.ascontiguousarray(dm, dtype=np.float64)
+        dm_splines = [X[:,slice_of_term] for _, slice_of_term, _ in missing_spline_terms]
+        missing_spectra = _get_df2lambda_spectra(dm_splines,
+                                                 [P for _, _, P in missing_spline_terms],
+                                                 [dm_spline.T @ dm_spline for dm_spline in dm_splines])
+        for (dm_term_name, _, _), spectrum in zip(missing_spline_terms, missing_spectra):
+            spectra[dm_term_name] = spectrum
+
+    return _get_P_from_design_info(dm.design_info, dfs, spectra, spline_terms)
+
+
+
+
+def _get_spline_terms(design_info):
+    """
+    Collects the smoothing spline terms of a patsy design matrix in the order of the formula.
+
+    Parameters
+    ----------
+        design_info: patsy DesignInfo
+            The design info of the design matrix.
+
+    Returns
+    -------
+        spline_terms: list of tuples
+            Term name, slice in the design matrix and penalty matrix of each smoothing spline term.
+    """
+    factor_infos = design_info.factor_infos
+    spline_terms = []
     
-    for term in terms:
+    for term in design_info.terms:
         dm_term_name = term.name()
 
         # get the slice object for this term (corresponding to start and end index in the design matrix)
-        slice_of_term = dm.design_info.term_name_slices[dm_term_name]
+        slice_of_term = design_info.term_name_slices[dm_term_name]
 
         # currently we only use smoothing for 1D, in the future we also want to add smoothing for tensorproducts
         if len(term.factors) == 1:
             factor_info = factor_infos[term.factors[0]]
-            num_columns = factor_info.num_columns
             
             P = _get_penalty_matrix_from_factor_info(factor_info)
                 
             if P is not False:
-                df = dfs[spline_counter] if type(dfs) == list else dfs
-                dm_spline = dm.iloc[:,slice_of_term]
+                spline_terms.append((dm_term_name, slice_of_term, P[0]))
+    return spline_terms
+
+
 
-                # Regularization parameters are given in degrees of freedom. Here they are converted to lambda.
-                df_lam = df2lambda(dm_spline, P[0], df)
-                big_P[slice_of_term,slice_of_term] = P[0]*df_lam[1]
-                spline_counter += 1
+
+def _get_P_from_design_info(design_info, dfs, spectra, spline_terms = None):
+    """
+    Computes the penalty matrix as get_P_from_design_matrix, but from the design info only. The design matrix itself is not 
+    needed, as long as the spectra of all spline terms are given.
+
+    Parameters
+    ----------
+        design_info: patsy DesignInfo
+            The design info of the design matrix.
+        dfs: int or list of ints
+            Degrees from freedom from which the smoothing parameter lambda is computed (see get_P_from_design_matrix).
+        spectra: dictionary
+            A dictionary where keys are the term names of the splines and values are the spectra used by df2lambda.
+        spline_terms: list of tuples, default None
+            The spline terms as returned by _get_spline_terms(design_info). Computed here if not given.
+
+    Returns
+    -------
+        big_P: numpy array
+            The penalty matrix of the design matrix.
+    """
+    if spline_terms is None:
+        spline_terms = _get_spline_terms(design_info)
+
+    num_columns = len(design_info.column_names)
+    big_P = np.zeros((num_columns,num_columns))
+
+    for spline_counter, (dm_term_name, slice_of_term, P) in enumerate(spline_terms):
+        df = dfs[spline_counter] if type(dfs) == list else dfs
+
+        # Regularization parameters are given in degrees of freedom. Here they are converted to lambda.
+        df_lam = df2lambda(None, P, df, spectrum = spectra[dm_term_name])
+        big_P[slice_of_term,slice_of_term] = P*df_lam[1]
     return big_P
 
 
 
 
-def _get_input_features_for_functional_expression(functional_expression : str, feature_names : list):
+@functools.lru_cache(maxsize=4096)
+def _get_input_features_for_functional_expression(functional_expression : str, feature_names : frozenset):
     '''
-    Parses variables from a functional expression using the python parser
+    Parses variables from a functional expression using the names of the compiled expression (string literals and names of 
+    keyword arguments, e.g. bs and df in spline(x1, bs="bs", df=4), are not part of these names).
+    The result is cached, as the same formulas are parsed again and again (e.g. when refitting with other degrees of freedom).
 
     Parameters
     ----------
         functional_expression: string
             Functional expression from which to extract the input features like "spline(x1,x2, bs="bs", df=4, degree=3)".
             
-        feature_names: set
-            Set of all possible feature names in the data set like [x1,x2,x3,x4,x5].
+        feature_names: frozenset
+            Set of all possible feature names in the data set like {x1,x2,x3,x4,x5}.
             
     Returns
     -------
-        input_features: list
-            List of feature names that appear as input in functional_expression. here in the example ["x1","x2"].
+        input_features: frozenset
+            Set of feature names that appear as input in functional_expression. here in the example {"x1","x2"}.
     '''
-    # co names are local variables of functions in a python expression
-    co_names = parser.expr(functional_expression).compile().co_names
-    co_names_set = set(co_names)
-    input_features = list(co_names_set.intersection(set(feature_names)))
+    identifiers = frozenset(compile(functional_expression, '<string>', 'eval').co_names)
+    input_features = identifiers.intersection(feature_names)
     return input_features
 
 
+@functools.lru_cache(maxsize=4096)
+def _get_input_features_for_factor_names(factor_names : tuple, feature_names : frozenset):
+    '''
+    Cached union of the input features of the factors of a term (see _get_all_input_features_for_term).
+
+    Parameters
+    ----------
+        factor_names: tuple of strings
+            Names of the factors of the term.
+        feature_names: frozenset
+            Set of all possible feature names in the data set.
+
+    Returns
+    -------
+        input_features_term: frozenset
+            Set of feature names that appear in any of the factors.
+    '''
+    input_features_term = frozenset()
+    for factor_name in factor_names:
+        input_features_term = input_features_term.union(_get_input_features_for_functional_expression(factor_name, feature_names))
+    return input_features_term
+
+
 def _get_all_input_features_for_term(term, feature_names):
     '''
-    Extracts all feature names that appear in a patsy term. For this it loops through all factors and uses then a python code paser to extract input variables.
+    Extracts all feature names that appear in a patsy term. For this it loops through all factors and extracts the input variables of each factor.
 
     Parameters
     ----------
@@ -367,7 +624,7 @@ def _get_all_input_features_for_term(term, feature_names):
             Patsy term object for which the feature names should be extracted.
             
         feature_names: list
-            List of all possible feature names in the data set like [x1,x2,x3,x4,x5].
+            List or set of all possible feature names in the data set like [x1,x2,x3,x4,x5].
             
     Returns
     -------
@@ -375,14 +632,10 @@ def _get_all_input_features_for_term(term, feature_names):
             List of feature names that appear in the patsy term. e.g. for a term x1:spline(x2, bs="bs", df=4, degree=3) -> 
             ["x1","x2"].
     '''
-    factors = term.factors
-    input_features_term = set()
-    for factor in factors:
-        factor_name = factor.name()
-        input_features_factor = _get_input_features_for_functional_expression(factor_name, list(feature_names))
-        input_features_term = input_features_term.union(set(input_features_factor))
-        
-    input_features_term = list(input_features_term)
+    factor_names = tuple(sorted(factor.name() for factor in term.factors))
+    
+    # a new list for each call, so that the cached set can not be changed by the caller
+    input_features_term = list(_get_input_features_for_factor_names(factor_names, frozenset(feature_names)))
     return input_features_term
 
 
@@ -416,6 +669,8 @@ def get_info_from_design_matrix(structured_matrix, feature_names):
                        'list_of_non_spline_input_features': [],
                        'list_of_term_names' : []}
     
+    feature_names = frozenset(feature_names)
+    
     for term in structured_matrix.design_info.terms:
         dm_term_name = term.name()
 
@@ -440,14 +695,14 @@ def get_info_from_design_matrix(structured_matrix, feature_names):
 
 
 
-def _orthogonalize(constraints, X):
+def _orthogonalize(Q, X):
     """
     Orthogonalize spline terms with respect to non spline terms.
 
     Parameters
     ----------
-        constraints: numpy array
-            constraint matrix, non spline terms
+        Q: numpy array
+            orthonormal basis of the constraint matrix (non spline terms), i.e. Q from its reduced QR decomposition
         X: numpy array
             spline terms
 
@@ -456,9 +711,9 @@ def _orthogonalize(constraints, X):
         constrained_X: numpy array
             orthogonalized spline terms
     """
-    Q, _ = np.linalg.qr(constraints) # compute Q
-    Projection_Matrix = np.matmul(Q,Q.T)
-    constrained_X = X - np.matmul(Projection_Matrix,X)
+    # project onto the column space of Q as Q @ (Q.T @ X), which avoids forming the n x n projection matrix Q @ Q.T
+    X = np.ascontiguousarray(X)
+    constrained_X = X - Q @ (Q.T @ X)
     return constrained_X
 
 
@@ -473,8 +728,8 @@ def orthogonalize_spline_wrt_non_splines(structured_matrix,
     
     Parameters
     ----------
-        structured_matrix: patsy.dmatrix
-            The design matrix for the structured part of the formula - computed by patsy
+        structured_matrix: numpy array or Pandas.DataFrame
+            The design matrix for the structured part of the formula - computed by patsy. A numpy array needs to be writeable.
         spline_info: dict
             dictionary with keys list_of_spline_slices and list_of_spline_input_features. As produced by
             get_info_from_design_matrix
@@ -482,20 +737,38 @@ def orthogonalize_spline_wrt_non_splines(structured_matrix,
             dictionary with keys list_of_non_spline_slices and list_of_non_spline_input_features. 
     '''
     
+    if isinstance(structured_matrix, pd.DataFrame):
+        # orthogonalize a numpy copy of the data frame and write the spline columns back
+        X = structured_matrix.to_numpy(dtype=np.float64, copy=True)
+        orthogonalize_spline_wrt_non_splines(X, spline_info, non_spline_info)
+        for spline_slice in spline_info['list_of_spline_slices']:
+            structured_matrix.iloc[:,spline_slice] = X[:,spline_slice]
+        return
+
+    # orthonormal bases of the constraint matrices. Splines with the same constraints (e.g. only an intercept) share one QR decomposition
+    Q_dict = dict()
+    
+    non_spline_slices = non_spline_info['list_of_non_spline_slices']
+    non_spline_input_features = [frozenset(features) for features in non_spline_info['list_of_non_spline_input_features']]
+    
     for spline_slice, spline_input_features in zip(spline_info['list_of_spline_slices'], 
                                                    spline_info['list_of_spline_input_features']):
         
-        X = structured_matrix.iloc[:,spline_slice]
-        # construct constraint matrix
-        constraints = []
-        for non_spline_slice, non_spline_input_features in zip(non_spline_info['list_of_non_spline_slices'], non_spline_info['list_of_non_spline_input_features']):
-            if set(non_spline_input_features).issubset(set(spline_input_features)):
-                constraints.append(structured_matrix.iloc[:,non_spline_slice].values)
-
-        if len(constraints)>0:
-            constraints = np.concatenate(constraints,axis=1)
-            constrained_X = _orthogonalize(constraints, np.array(X))
-            structured_matrix.iloc[:,spline_slice] = constrained_X
+        # find the non spline terms of the constraint matrix
+        spline_input_features = frozenset(spline_input_features)
+        constraint_term_indices = tuple(i for i, features in enumerate(non_spline_input_features) 
+                                        if features.issubset(spline_input_features))
+
+        if len(constraint_term_indices)>0:
+            # construct constraint matrix (non spline terms are not changed by the orthogonalization, so Q can be reused). 
+            # The columns of all constraint terms are gathered with a single fancy index
+            if constraint_term_indices not in Q_dict:
+                constraint_columns = np.fromiter((column for i in constraint_term_indices 
+                                                  for column in range(non_spline_slices[i].start, non_spline_slices[i].stop)), 
+                                                 dtype=np.intp)
+                Q_dict[constraint_term_indices], _ = np.linalg.qr(structured_matrix[:,constraint_columns], mode='reduced') # compute Q
+            constrained_X = _orthogonalize(Q_dict[constraint_term_indices], structured_matrix[:,spline_slice])
+            structured_matrix[:,spline_slice] = constrained_X
         
             
 def compute_orthogonalization_pattern_deepnets(net_feature_names, 
@@ -2,6 +2,7 @@ import sys
 import os
 
 import unittest
+import functools
 
 import numpy as np
 from torch import nn
@@ -19,6 +20,16 @@ from sddr.utils.splines import spline, Spline
 from sddr.utils import checkups
 from sddr.utils.prepare_data import PrepareData
 
+
+@functools.lru_cache(maxsize=None)
+def _load_iris():
+    '''
+    Fetches the iris data set once per test run and renames the columns to x1,...,x4 and y.
+    '''
+    iris = sm.datasets.get_rdataset('iris').data
+    return iris.rename(columns={'Sepal.Length':'x1','Sepal.Width':'x2','Petal.Length':'x3','Petal.Width':'x4','Species':'y'})
+
+
 class TestSddrDataset(unittest.TestCase):
     '''
     Test SddrDataset for model with a linear part, splines and deep networks using the iris data set. 
@@ -33,10 +44,18 @@ class TestSddrDataset(unittest.TestCase):
     '''
 
 
-    def __init__(self,*args,**kwargs):
+    @classmethod
+    def setUpClass(cls):
 
-        super(TestSddrDataset, self).__init__(*args,**kwargs)
+        # load data once for all tests of this class
+        cls.data_path = '../data/test_data/x.csv'
+        cls.ground_truth_path = '../data/test_data/y.csv'
 
+        cls.data = pd.read_csv(cls.data_path ,sep=None,engine='python')
+        cls.target = pd.read_csv(cls.ground_truth_path)
+
+
+    def setUp(self):
 
         #define distribution
         self.current_distribution  = 'Poisson'
@@ -62,13 +81,6 @@ class TestSddrDataset(unittest.TestCase):
         }
 
 
-        # load data
-        self.data_path = '../data/test_data/x.csv'
-        self.ground_truth_path = '../data/test_data/y.csv'
-
-        self.data = pd.read_csv(self.data_path ,sep=None,engine='python')
-        self.target = pd.read_csv(self.ground_truth_path)
-
         self.true_feature_names = ["x1", "x2", "x3", "x4"]
         self.true_x2_11 = np.float32(self.data.x2[11])
         self.true_target_11 = self.target.values[11]
@@ -195,20 +207,29 @@ class TestPrepareData(unittest.TestCase):
     '''
 
 
-    def __init__(self,*args,**kwargs):
-
-        super(TestPrepareData, self).__init__(*args,**kwargs)
+    @classmethod
+    def setUpClass(cls):
 
-
-        # load data
+        # load data once for all tests of this class
         data_path = '../data/test_data/x.csv'
         ground_truth_path = '../data/test_data/y.csv'
 
-        self.x = pd.read_csv(data_path, sep=None, engine='python')
-        self.y = pd.read_csv(ground_truth_path)
+        cls.x = pd.read_csv(data_path, sep=None, engine='python')
+        cls.y = pd.read_csv(ground_truth_path)
+        cls._dmatrix_cache = dict()
 
         # iris = sm.datasets.get_rdataset('iris').data
         # self.x = iris.rename(columns={'Sepal.Length':'x1','Sepal.Width':'x2','Petal.Length':'x3','Petal.Width':'x4','Species':'y'})
+
+
+    def _dmatrix(self, formula):
+        """
+        Returns the patsy design matrix of formula for self.x. Design matrices are built once per formula and shared between
+        the tests of this class, so they must not be changed inplace.
+        """
+        if formula not in self._dmatrix_cache:
+            self._dmatrix_cache[formula] = dmatrix(formula, self.x, return_type='dataframe')
+        return self._dmatrix_cache[formula]
         
         
     def test_patsyfreedummytest_parse_formulas(self):
@@ -290,8 +311,8 @@ class TestPrepareData(unittest.TestCase):
         network_info_dict = prepare_data.network_info_dict
         P = prepare_data.P
         
-        ground_truth_loc = dmatrix(formulas['loc'], self.x, return_type='dataframe').to_numpy()
-        ground_truth_scale = dmatrix(formulas['scale'], self.x, return_type='dataframe').to_numpy()
+        ground_truth_loc = self._dmatrix(formulas['loc']).to_numpy()
+        ground_truth_scale = self._dmatrix(formulas['scale']).to_numpy()
         ground_truth_loc = torch.from_numpy(ground_truth_loc).float()
         ground_truth_scale = torch.from_numpy(ground_truth_scale).float()
 
@@ -348,8 +369,8 @@ class TestPrepareData(unittest.TestCase):
         network_info_dict = prepare_data.network_info_dict
         P = prepare_data.P
         
-        ground_truth_loc = dmatrix('~1', self.x, return_type='dataframe').to_numpy()
-        ground_truth_scale = dmatrix('~1 + x1', self.x, return_type='dataframe').to_numpy()
+        ground_truth_loc = self._dmatrix('~1').to_numpy()
+        ground_truth_scale = self._dmatrix('~1 + x1').to_numpy()
         ground_truth_loc = torch.from_numpy(ground_truth_loc).float()
         ground_truth_scale = torch.from_numpy(ground_truth_scale).float()
         
@@ -420,8 +441,8 @@ class TestPrepareData(unittest.TestCase):
         network_info_dict = prepare_data.network_info_dict
         P = prepare_data.P
 
-        ground_truth_loc = dmatrix('~-1 + spline(x1,bs="bs",df=4, degree=3):x2 + spline(x2,bs="bs",df=5, degree=3):x1', self.x, return_type='dataframe').to_numpy()
-        ground_truth_scale = dmatrix('~1 + x1 + spline(x1,bs="bs",df=10, degree=3)', self.x, return_type='dataframe').to_numpy()
+        ground_truth_loc = self._dmatrix('~-1 + spline(x1,bs="bs",df=4, degree=3):x2 + spline(x2,bs="bs",df=5, degree=3):x1').to_numpy()
+        ground_truth_scale = self._dmatrix('~1 + x1 + spline(x1,bs="bs",df=10, degree=3)').to_numpy()
         ground_truth_loc = torch.from_numpy(ground_truth_loc).float()
         ground_truth_scale = torch.from_numpy(ground_truth_scale).float()
 
@@ -485,7 +506,7 @@ class TestPrepareData(unittest.TestCase):
 
 
         # calculate regularization parameter lambda
-        dm_spline = dmatrix(formulas['rate'], self.x, return_type='dataframe')
+        dm_spline = self._dmatrix(formulas['rate'])
         df_lam = df2lambda(dm_spline, P_original, degrees_of_freedom['rate'])
 
 
@@ -499,8 +520,169 @@ class TestPrepareData(unittest.TestCase):
         self.assertTrue(lam == df_lam[1])
         self.assertTrue(df_lam[0] == degrees_of_freedom['rate'])
         self.assertTrue((P_original == (P_penalized / df_lam[1])).all())
-        
-        
+
+
+    def test_penalty_matrix_multiple_splines(self):
+        """
+        Test if the penalty matrix of a formula with several splines of different sizes (whose lambdas are computed together)
+        is equal to the penalties computed separately for each spline.
+        """
+
+
+        # define formulas and network shape
+        formulas = dict()
+        formulas['rate'] = "~1 + x1 + spline(x1, bs='bs', df=9, degree=3) + spline(x2, bs='cc', df=6)"
+
+        degrees_of_freedom = {'rate': [4, 3]}
+
+        deep_models_dict = dict()
+
+
+        # call parse_formulas
+        prepare_data = PrepareData(formulas, deep_models_dict, degrees_of_freedom)
+        prepare_data.fit(self.x)
+        P = prepare_data.P['rate']
+
+
+        # compute penalties of the splines separately
+        dm = self._dmatrix(formulas['rate'])
+        P_true = np.zeros(P.shape)
+        for spline_slice, x, bs, df, spline_df in [(slice(2, 11), self.x.x1, 'bs', 9, 4), (slice(11, 17), self.x.x2, 'cc', 6, 3)]:
+            sp = Spline()
+            sp.memorize_chunk(x, bs=bs, df=df, degree=3)
+            P_original = sp.penalty_matrices[0]
+            df_lam = df2lambda(dm.iloc[:, spline_slice], P_original, spline_df)
+            P_true[spline_slice, spline_slice] = P_original * df_lam[1]
+
+
+        # test if penalty matrices are equal
+        self.assertEqual(P.shape, (17, 17))
+        self.assertTrue(np.allclose(P, P_true))
+
+
+    def test_refit_with_other_degrees_of_freedom(self):
+        """
+        Test if fitting the same formula on the same data again with other degrees of freedom reuses the design matrix
+        and still computes the correct regularization parameter lambda.
+        """
+
+
+        # define formulas and network shape
+        formulas = dict()
+        formulas['rate'] = "~ -1 + spline(x1, bs='bs', df=9, degree=3)"
+
+        deep_models_dict = dict()
+
+
+        # fit twice with different degrees of freedom
+        prepare_data_4 = PrepareData(formulas, deep_models_dict, {'rate': 4})
+        prepare_data_4.fit(self.x)
+        prepare_data_6 = PrepareData(formulas, deep_models_dict, {'rate': 6})
+        prepare_data_6.fit(self.x)
+
+
+        # calculate regularization parameter lambda from scratch
+        sp = Spline()
+        sp.memorize_chunk(self.x.x1, bs="bs", df=9, degree=3)
+        P_original = sp.penalty_matrices[0]
+        df_lam = df2lambda(self._dmatrix(formulas['rate']), P_original, 6)
+
+
+        # test if the design matrix was reused and lambda is correct for the new degrees of freedom
+        self.assertIs(prepare_data_4.structured_matrix_design_info['rate'], prepare_data_6.structured_matrix_design_info['rate'])
+        self.assertTrue(np.allclose(prepare_data_6.P['rate'], P_original * df_lam[1]))
+        self.assertFalse(np.allclose(prepare_data_4.P['rate'], prepare_data_6.P['rate']))
+
+
+    def test_refit_with_other_categories(self):
+        """
+        Test if fitting the same formula on data with the same values but other dtypes (here a categorical with other 
+        categories) does not reuse the design matrix of the first fit.
+        """
+
+
+        # define formulas and network shape
+        formulas = dict()
+        formulas['rate'] = "~1 + x1 + g"
+
+        deep_models_dict = dict()
+
+
+        # same values of g, once as strings and once as categorical with another reference level and an unused level (ordered,
+        # as fit computes the range of all columns)
+        data_object = self.x.copy()
+        data_object['g'] = np.array(['a', 'b', 'c'])[np.arange(len(data_object)) % 3]
+        data_categorical = data_object.copy()
+        data_categorical['g'] = pd.Categorical(data_object['g'], categories=['c', 'b', 'a', 'z'], ordered=True)
+
+        prepare_data_object = PrepareData(formulas, deep_models_dict, {'rate': 4})
+        prepare_data_object.fit(data_object)
+        prepare_data_categorical = PrepareData(formulas, deep_models_dict, {'rate': 4})
+        prepare_data_categorical.fit(data_categorical)
+
+
+        # test if the design matrix was built again with the categories of the categorical
+        ground_truth = dmatrix(formulas['rate'], data_categorical, return_type='dataframe')
+        design_info = prepare_data_categorical.structured_matrix_design_info['rate']
+        self.assertIsNot(prepare_data_object.structured_matrix_design_info['rate'], design_info)
+        self.assertEqual(design_info.column_names, list(ground_truth.columns))
+        self.assertEqual(prepare_data_categorical.network_info_dict['rate']['struct_shapes'], ground_truth.shape[1])
+
+
+    def test_df_from_lambda(self):
+        """
+        Test if degrees of freedom are correctly computed from a given lambda, both as trace of the hat matrix H (hat1=True)
+        and as trace of 2H - H^2 (hat1=False).
+        """
+
+
+        # get spline design matrix and its penalty matrix
+        dm_spline = self._dmatrix("~ -1 + spline(x1, bs='bs', df=9, degree=3)")
+        sp = Spline()
+        sp.memorize_chunk(self.x.x1, bs="bs", df=9, degree=3)
+        P = sp.penalty_matrices[0]
+        lam = 0.5
+
+
+        # compute the hat matrix explicitly
+        X = dm_spline.to_numpy()
+        H = X @ np.linalg.solve(X.T @ X + lam * P, X.T)
+
+
+        # test if degrees of freedom are equal to the trace of the corresponding matrices
+        self.assertAlmostEqual(df2lambda(dm_spline, P, None, lam=lam)[0], np.trace(H), places=6)
+        self.assertAlmostEqual(df2lambda(dm_spline, P, None, lam=lam, hat1=False)[0], np.trace(2 * H - H @ H), places=6)
+
+
+    def test_lambda_for_rank_deficient_spline(self):
+        """
+        Test if lambda gives the requested degrees of freedom (trace of the hat matrix) for a spline basis that is rank deficient, 
+        because it has more basis functions than distinct values of its input (x2 has 23 distinct values).
+        """
+
+
+        deep_models_dict = dict()
+
+        # the rank deficient spline alone and together with a second spline (where the spectra of both are computed together)
+        for formula in ["~ -1 + spline(x2, bs='bs', df=25, degree=3)", 
+                        "~ -1 + spline(x2, bs='bs', df=25, degree=3) + spline(x1, bs='bs', df=9, degree=3)"]:
+            formulas = dict()
+            formulas['rate'] = formula
+
+            prepare_data = PrepareData(formulas, deep_models_dict, {'rate': 5})
+            prepare_data.fit(self.x)
+
+
+            # compute the hat matrix of the rank deficient spline explicitly with its penalty (multiplied by lambda)
+            X = self._dmatrix(formulas['rate']).to_numpy()[:, :25]
+            H = X @ np.linalg.solve(X.T @ X + prepare_data.P['rate'][:25, :25], X.T)
+
+
+            # test if the design matrix is rank deficient and the degrees of freedom are correct
+            self.assertLess(np.linalg.matrix_rank(X), X.shape[1])
+            self.assertAlmostEqual(np.trace(H), 5, places=3)
+
+
     def test_orthogonalization_of_unstructured_part_in_parse_formulas(self):
         """
         Test if parse_formulas is correctly computing the orthogonalization pattern of the unstructured part.
@@ -531,7 +713,7 @@ class TestPrepareData(unittest.TestCase):
         dm_info_dict = prepare_data.dm_info_dict
         network_info_dict = prepare_data.network_info_dict
         
-        X=dmatrix("~1 + x1 + x2 + spline(x3, bs='bs', df=9, degree=3)", self.x, return_type='dataframe')
+        X=self._dmatrix("~1 + x1 + x2 + spline(x3, bs='bs', df=9, degree=3)")
         
         orthogonalization_pattern = network_info_dict['loc']['orthogonalization_pattern']['d1']
         true_column_names = []
@@ -548,7 +730,7 @@ class TestPrepareData(unittest.TestCase):
         column_names = set([list(X.iloc[:,sl].columns)[-1] for sl in orthogonalization_pattern])
         self.assertTrue(len(column_names.symmetric_difference(set(true_column_names))) == 0)  #test if column names and true_column_names are identical
         
-        X=dmatrix("~1 + x1", self.x, return_type='dataframe')
+        X=self._dmatrix("~1 + x1")
         
         orthogonalization_pattern = network_info_dict['loc']['orthogonalization_pattern']['d1']
         true_column_names = []
@@ -567,8 +749,11 @@ class Testorthogonalize_spline_wrt_non_splines(unittest.TestCase):
     '''
 
 
-    def __init__(self,*args,**kwargs):
-        super(Testorthogonalize_spline_wrt_non_splines, self).__init__(*args,**kwargs)
+    @classmethod
+    def setUpClass(cls):
+
+        # load data once for all tests of this class
+        cls.data = _load_iris()
 
 
     def test_case_one(self):
@@ -578,22 +763,19 @@ class Testorthogonalize_spline_wrt_non_splines(unittest.TestCase):
         '''
 
 
-        # load data
-        iris = sm.datasets.get_rdataset('iris').data
-        data = iris.rename(columns={'Sepal.Length':'x1','Sepal.Width':'x2','Petal.Length':'x3','Petal.Width':'x4','Species':'y'})
+        data = self.data
 
         structured_matrix = dmatrix('~ 1 + x1 + x2 + spline(x1, bs="bs", df=4, return_penalty = False, degree=3)', data, return_type='dataframe')
 
         spline_info, non_spline_info = get_info_from_design_matrix(structured_matrix, data.columns)
+        X = structured_matrix.to_numpy(copy=True)
         
         
-        orthogonalize_spline_wrt_non_splines(structured_matrix, spline_info, non_spline_info)
+        orthogonalize_spline_wrt_non_splines(X, spline_info, non_spline_info)
 
-        test_features_not_zero = abs(structured_matrix).values.max().min() > 0
+        test_features_not_zero = abs(X).max().min() > 0
         self.assertTrue(test_features_not_zero) #test if features are not just equal to a zero vector
 
-        p=structured_matrix.shape[1]
-
         correct_orthogonality_pattern = np.array([[1., 1., 1., 0., 0., 0., 0.],
                                                   [1., 1., 1., 0., 0., 0., 0.],
                                                   [1., 1., 1., 1., 1., 1., 1.],
@@ -602,11 +784,8 @@ class Testorthogonalize_spline_wrt_non_splines(unittest.TestCase):
                                                   [0., 0., 1., 1., 1., 1., 1.],
                                                   [0., 0., 1., 1., 1., 1., 1.]])
 
-        for i in range(p):
-            for j in range(p):
-                is_not_orthogonal = abs(np.matmul(structured_matrix.values[:,i], structured_matrix.values[:,j]))>0.01
-                test_orthog = correct_orthogonality_pattern[i,j] == is_not_orthogonal
-                self.assertTrue(test_orthog) #test if orthogonality is correct 
+        is_not_orthogonal = np.abs(X.T @ X) > 0.01 # all pairwise inner products of the columns at once
+        self.assertTrue(np.array_equal(is_not_orthogonal, correct_orthogonality_pattern.astype(bool))) #test if orthogonality is correct 
         
         
     def test_case_two(self):
@@ -616,21 +795,18 @@ class Testorthogonalize_spline_wrt_non_splines(unittest.TestCase):
         '''
 
 
-        # load data
-        iris = sm.datasets.get_rdataset('iris').data
-        data = iris.rename(columns={'Sepal.Length':'x1','Sepal.Width':'x2','Petal.Length':'x3','Petal.Width':'x4','Species':'y'})
+        data = self.data
 
         structured_matrix = dmatrix('~ 1 + x1 + x2 + spline(x1, bs="bs", df=4, return_penalty = False, degree=3):x2', data, return_type='dataframe')
 
         spline_info, non_spline_info = get_info_from_design_matrix(structured_matrix, data.columns)
+        X = structured_matrix.to_numpy(copy=True)
 
-        orthogonalize_spline_wrt_non_splines(structured_matrix, spline_info, non_spline_info)
+        orthogonalize_spline_wrt_non_splines(X, spline_info, non_spline_info)
 
-        test_features_not_zero = abs(structured_matrix).values.max().min() > 0
+        test_features_not_zero = abs(X).max().min() > 0
         self.assertTrue(test_features_not_zero) #test if features are not just equal to a zero vector
 
-        p=structured_matrix.shape[1]
-
         correct_orthogonality_pattern = np.array([[1., 1., 1., 0., 0., 0., 0.],
                                                   [1., 1., 1., 0., 0., 0., 0.],
                                                   [1., 1., 1., 0., 0., 0., 0.],
@@ -639,11 +815,50 @@ class Testorthogonalize_spline_wrt_non_splines(unittest.TestCase):
                                                   [0., 0., 0., 1., 1., 1., 1.],
                                                   [0., 0., 0., 1., 1., 1., 1.]])
 
-        for i in range(p):
-            for j in range(p):
-                is_not_orthogonal = abs(np.matmul(structured_matrix.values[:,i], structured_matrix.values[:,j]))>0.01
-                test_orthog = correct_orthogonality_pattern[i,j] == is_not_orthogonal
-                self.assertTrue(test_orthog) #test if orthogonality is correct 
+        is_not_orthogonal = np.abs(X.T @ X) > 0.01 # all pairwise inner products of the columns at once
+        self.assertTrue(np.array_equal(is_not_orthogonal, correct_orthogonality_pattern.astype(bool))) #test if orthogonality is correct 
+        
+        
+    def test_case_three(self):
+        '''
+        Test with variables named like the keyword arguments of the spline (b for bs, d for df and degree) and a spline that is 
+        only dependent on a.
+        Orthogonalization should be w.r.t. intercept only, keyword arguments must not be taken as input features
+        '''
+
+
+        data = self.data.rename(columns={'x1': 'a', 'x2': 'b', 'x3': 'd'})
+
+        structured_matrix = dmatrix('~ 1 + b + spline(a, bs="bs", df=4, return_penalty = False, degree=3)', data, return_type='dataframe')
+
+        spline_info, non_spline_info = get_info_from_design_matrix(structured_matrix, data.columns)
+        self.assertEqual(spline_info['list_of_spline_input_features'], [['a']])
+        X = structured_matrix.to_numpy(copy=True)
+
+        orthogonalize_spline_wrt_non_splines(X, spline_info, non_spline_info)
+
+        inner_products = np.abs(X.T @ X)
+        self.assertTrue((inner_products[0, 2:] < 0.01).all()) #test if the spline is orthogonal to the intercept
+        self.assertTrue((inner_products[1, 2:] > 0.01).any()) #test if the spline is not orthogonalized w.r.t. b
+        
+        
+    def test_case_data_frame(self):
+        '''
+        Test if a data frame is orthogonalized inplace in the same way as a numpy array.
+        '''
+
+
+        data = self.data
+
+        structured_matrix = dmatrix('~ 1 + x1 + x2 + spline(x1, bs="bs", df=4, return_penalty = False, degree=3)', data, return_type='dataframe')
+
+        spline_info, non_spline_info = get_info_from_design_matrix(structured_matrix, data.columns)
+        X = structured_matrix.to_numpy(copy=True)
+
+        orthogonalize_spline_wrt_non_splines(X, spline_info, non_spline_info)
+        orthogonalize_spline_wrt_non_splines(structured_matrix, spline_info, non_spline_info)
+
+        self.assertTrue(np.allclose(structured_matrix.to_numpy(), X)) #test if the data frame was changed like the numpy array
         
         
 if __name__ == '__main__':